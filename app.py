@@ -2,12 +2,26 @@ from flask import Flask, render_template, request, jsonify, flash, redirect, url
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from flask_wtf.csrf import CSRFProtect, generate_csrf
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask_caching import Cache
+from flask_socketio import SocketIO, join_room
+from werkzeug.security import check_password_hash
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+import gevent
+from gevent import monkey
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.exc import OperationalError, ProgrammingError
+from sqlalchemy.orm import joinedload, load_only
 from datetime import datetime, timedelta
-import json
+from concurrent.futures import ThreadPoolExecutor
 import os
+import json
+import time
 import cloudinary
 import cloudinary.uploader
+import cloudinary.utils
+import cloudinary.api
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -18,13 +32,85 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('FLASK_SECRET', 'dev-secret-key')
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///app.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+
+# Connection pool: cek koneksi sebelum dipakai dan daur ulang koneksi lama
+engine_options = {
+    'pool_pre_ping': True,
+    'pool_recycle': 1800,
+    'query_cache_size': 1200
+}
+# SQLite in-memory memakai StaticPool yang tidak menerima pool_size/max_overflow
+database_uri = app.config['SQLALCHEMY_DATABASE_URI']
+is_memory_sqlite = database_uri in ('sqlite://', 'sqlite:///') or ':memory:' in database_uri
+if not is_memory_sqlite:
+    # Pool berlaku per worker: bagi batas koneksi database ke semua worker
+    # Gunicorn (default 80, di bawah max_connections PostgreSQL = 100)
+    db_max_connections = int(os.environ.get('DB_MAX_CONNECTIONS', 80))
+    web_workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+    connections_per_worker = max(db_max_connections // web_workers, 2)
+    pool_size = max(connections_per_worker // 3, 1)
+    engine_options.update(
+        pool_size=pool_size,
+        max_overflow=connections_per_worker - pool_size
+    )
+if database_uri.startswith(('postgresql://', 'postgresql+psycopg2://')):
+    engine_options['executemany_mode'] = 'values_plus_batch'
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=7)
 
+# Cache: Redis jika REDIS_URL tersedia, selain itu cache in-memory per proses
+if os.environ.get('REDIS_URL'):
+    app.config['CACHE_TYPE'] = 'RedisCache'
+    app.config['CACHE_REDIS_URL'] = os.environ.get('REDIS_URL')
+else:
+    app.config['CACHE_TYPE'] = 'SimpleCache'
+app.config['CACHE_DEFAULT_TIMEOUT'] = 300
+
+# Batas upload Cloudinary yang berjalan bersamaan dalam satu request
+MAX_PARALLEL_UPLOADS = 8
+
+# Jumlah pesan per halaman riwayat chat
+MESSAGES_PER_PAGE = 50
+
+# Format yang boleh diupload langsung dari browser (sama dengan input file di chat)
+DIRECT_UPLOAD_FORMATS = 'jpg,jpeg,png,gif,webp,mp4,avi,mov,wmv,mkv,pdf,doc,docx'
+
+# Jumlah maksimal public_id per panggilan delete_resources Cloudinary
+CLOUDINARY_DELETE_BATCH = 100
+
+# Argon2id untuk hash password (~8x lebih murah dari pbkdf2 600k iterasi)
+password_hasher = PasswordHasher(time_cost=2, memory_cost=19 * 1024, parallelism=1)
+
+def verify_password_hash(password_hash, password):
+    # Exception ditangkap di sini agar threadpool gevent tidak mencetak
+    # traceback untuk setiap password yang salah
+    try:
+        return password_hasher.verify(password_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+def run_in_native_thread(func, *args):
+    """Jalankan fungsi CPU-bound yang melepas GIL di thread OS asli.
+    
+    Di worker gevent semua greenlet berbagi satu thread, jadi hashing
+    password akan menghentikan greenlet lain. Threadpool hub gevent
+    memakai thread native sehingga greenlet lain tetap berjalan.
+    """
+    if monkey.is_module_patched('threading'):
+        return gevent.get_hub().threadpool.apply(func, args)
+    return func(*args)
+
+# Interval minimum antara penulisan last_seen ke database
+LAST_SEEN_UPDATE_INTERVAL = timedelta(seconds=60)
+
 # Inisialisasi ekstensi
 db = SQLAlchemy(app)
 login_manager = LoginManager(app)
 csrf = CSRFProtect(app)
+cache = Cache(app)
+# Message queue Redis diperlukan agar emit sampai ke klien di worker lain
+socketio = SocketIO(app, message_queue=os.environ.get('REDIS_URL'))
 
 # Konfigurasi Login Manager
 login_manager.login_view = 'login'
@@ -46,7 +132,7 @@ class User(UserMixin, db.Model):
     password_hash = db.Column(db.String(255), nullable=False)
     profile_picture = db.Column(db.String(500), default='https://res.cloudinary.com/dzfkklsza/image/upload/v1700000000/default_avatar.png')
     bio = db.Column(db.Text, default='')
-    social_links = db.Column(db.Text, default='[]')
+    social_links = db.Column(db.JSON().with_variant(JSONB(), 'postgresql'), default=list)
     is_admin = db.Column(db.Boolean, default=False)
     is_active = db.Column(db.Boolean, default=True)
     is_blocked = db.Column(db.Boolean, default=False)
@@ -57,19 +143,24 @@ class User(UserMixin, db.Model):
     received_messages = db.relationship('Message', foreign_keys='Message.receiver_id', backref='receiver', lazy='dynamic')
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = run_in_native_thread(password_hasher.hash, password)
     
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if not self.password_hash.startswith('$argon2'):
+            # Hash lama dari Werkzeug (pbkdf2)
+            return run_in_native_thread(check_password_hash, self.password_hash, password)
+        return run_in_native_thread(verify_password_hash, self.password_hash, password)
+    
+    def password_needs_rehash(self):
+        if not self.password_hash.startswith('$argon2'):
+            return True
+        return password_hasher.check_needs_rehash(self.password_hash)
     
     def get_social_links(self):
-        try:
-            return json.loads(self.social_links)
-        except:
-            return []
+        return self.social_links or []
     
     def set_social_links(self, links_list):
-        self.social_links = json.dumps(links_list)
+        self.social_links = links_list
     
     def can_chat(self):
         return self.is_active and not self.is_blocked
@@ -79,13 +170,6 @@ class User(UserMixin, db.Model):
             return False
         return self.last_seen > datetime.utcnow() - timedelta(minutes=5)
     
-    def get_unread_count(self, sender_id):
-        return Message.query.filter_by(
-            sender_id=sender_id,
-            receiver_id=self.id,
-            is_read=False
-        ).count()
-    
     def __repr__(self):
         return f'<User {self.username}>'
 
@@ -94,30 +178,83 @@ class Message(db.Model):
     content = db.Column(db.Text, nullable=True)
     media_url = db.Column(db.String(500))
     media_type = db.Column(db.String(20))
+    public_id = db.Column(db.String(255))
     is_read = db.Column(db.Boolean, default=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     
     sender_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     receiver_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     
-    def to_dict(self):
+    __table_args__ = (
+        db.Index('ix_msg_conv', 'sender_id', 'receiver_id', 'id'),
+        db.Index('ix_msg_unread', 'receiver_id', 'sender_id', 'is_read'),
+    )
+    
+    @staticmethod
+    def conversation(user_id, other_user_id, *criteria):
+        """Query pesan dua arah antara dua user.
+        
+        Setiap arah diquery terpisah lalu digabung dengan UNION ALL supaya
+        masing-masing memakai index ix_msg_conv, bukan scan dengan OR.
+        """
+        sent = Message.query.filter(
+            Message.sender_id == user_id,
+            Message.receiver_id == other_user_id,
+            *criteria
+        )
+        received = Message.query.filter(
+            Message.sender_id == other_user_id,
+            Message.receiver_id == user_id,
+            *criteria
+        )
+        return sent.union_all(received)
+    
+    def to_dict(self, sender=None):
+        sender = sender or self.sender
         return {
             'id': self.id,
             'content': self.content,
             'media_url': self.media_url,
             'media_type': self.media_type,
             'is_read': self.is_read,
-            'timestamp': self.timestamp.strftime('%H:%M'),
-            'full_timestamp': self.timestamp.strftime('%d %b %Y %H:%M'),
+            # ISO 8601 (UTC); format jam ditampilkan di browser
+            'timestamp': self.timestamp.isoformat() + 'Z',
             'sender_id': self.sender_id,
             'receiver_id': self.receiver_id,
-            'sender_username': self.sender.username,
-            'sender_profile_pic': self.sender.profile_picture
+            'sender_username': sender.username,
+            'sender_profile_pic': sender.profile_picture
         }
+    
+    @classmethod
+    def bulk_to_dict(cls, messages):
+        """Serialisasi banyak pesan dengan satu query untuk semua pengirim"""
+        sender_ids = {msg.sender_id for msg in messages}
+        if not sender_ids:
+            return []
+        
+        senders = {user.id: user for user in User.query.filter(User.id.in_(sender_ids)).all()}
+        return [msg.to_dict(senders[msg.sender_id]) for msg in messages]
+
+@cache.memoize(timeout=300)
+def get_cached_user(user_id):
+    # Hanya kolom yang dipakai di setiap request yang disimpan di cache;
+    # password_hash, email, bio dan social_links dimuat dari database saat
+    # diakses sehingga kredensial tidak ikut tersimpan di backend cache
+    return User.query.options(load_only(
+        User.username, User.profile_picture, User.is_admin, User.is_active,
+        User.is_blocked, User.last_seen, User.created_at
+    )).get(user_id)
+
+def invalidate_user_cache(user_id):
+    cache.delete_memoized(get_cached_user, int(user_id))
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    user = get_cached_user(int(user_id))
+    if user is None:
+        return None
+    # Pasang kembali ke session tanpa SELECT agar perubahan tetap bisa di-commit
+    return db.session.merge(user, load=False)
 
 # Context Processor untuk template
 @app.context_processor
@@ -129,15 +266,32 @@ def utility_processor():
     }
 
 # Helper Functions
+def get_resource_type(filename):
+    file_extension = filename.lower().split('.')[-1]
+    
+    if file_extension in ['jpg', 'jpeg', 'png', 'gif', 'webp']:
+        return "image"
+    elif file_extension in ['mp4', 'avi', 'mov', 'wmv', 'mkv']:
+        return "video"
+    return "auto"
+
+def get_media_type(resource_type, filename):
+    """Tipe media untuk ditampilkan, dari resource_type asli Cloudinary.
+    
+    Dipakai oleh upload lewat server maupun upload langsung dari browser
+    agar file yang sama selalu disimpan dengan tipe yang sama. File
+    non-gambar yang disimpan Cloudinary sebagai image (mis. PDF) dan file
+    raw ditampilkan sebagai link download ('auto').
+    """
+    if resource_type == 'video':
+        return 'video'
+    if resource_type == 'image' and get_resource_type(filename) == 'image':
+        return 'image'
+    return 'auto'
+
 def upload_to_cloudinary(file, folder="chat_app"):
     try:
-        file_extension = file.filename.lower().split('.')[-1]
-        resource_type = "auto"
-        
-        if file_extension in ['jpg', 'jpeg', 'png', 'gif', 'webp']:
-            resource_type = "image"
-        elif file_extension in ['mp4', 'avi', 'mov', 'wmv', 'mkv']:
-            resource_type = "video"
+        resource_type = get_resource_type(file.filename)
         
         result = cloudinary.uploader.upload(
             file,
@@ -151,11 +305,96 @@ def upload_to_cloudinary(file, folder="chat_app"):
             'success': True,
             'url': result['secure_url'],
             'public_id': result['public_id'],
-            'resource_type': resource_type
+            'resource_type': get_media_type(result['resource_type'], file.filename)
         }
     except Exception as e:
         return {'success': False, 'error': str(e)}
 
+def is_valid_direct_upload(url, public_id, version, signature):
+    """Pastikan hasil upload langsung dari browser benar-benar milik request ini.
+    
+    Signature dari response upload Cloudinary membuktikan public_id dan
+    version berasal dari upload tersebut, dan URL harus menunjuk ke file
+    yang sama di akun Cloudinary aplikasi ini.
+    """
+    if not public_id.startswith('chat_app/') or not version or not signature:
+        return False
+    
+    try:
+        if not cloudinary.utils.verify_api_response_signature(public_id, version, signature):
+            return False
+    except Exception:
+        return False
+    
+    # URL: https://res.cloudinary.com/<cloud>/<type>/upload/v<version>/<public_id>[.<ext>]
+    cloudinary_prefix = f"https://res.cloudinary.com/{cloudinary.config().cloud_name}/"
+    path = url.split('?')[0]
+    if not path.startswith(cloudinary_prefix):
+        return False
+    # public_id file raw sudah termasuk ekstensi, selain itu URL diakhiri .<ext>
+    expected = f"/v{version}/{public_id}"
+    return path.endswith(expected) or path.rsplit('.', 1)[0].endswith(expected)
+
+def upload_many(files, folder="chat_app"):
+    """Upload beberapa file ke Cloudinary secara paralel.
+    
+    Hasil dikembalikan dengan urutan yang sama dengan `files`. Jumlah upload
+    bersamaan dibatasi agar tidak terkena rate limit Cloudinary.
+    """
+    if len(files) == 1:
+        return [upload_to_cloudinary(files[0], folder)]
+    
+    with ThreadPoolExecutor(max_workers=min(len(files), MAX_PARALLEL_UPLOADS)) as executor:
+        return list(executor.map(lambda f: upload_to_cloudinary(f, folder), files))
+
+@cache.cached(timeout=30, key_prefix='admin_stats')
+def get_admin_stats():
+    """Statistik user dan pesan untuk halaman admin dalam satu query"""
+    online_since = datetime.utcnow() - timedelta(minutes=5)
+    row = db.session.query(
+        func.count(User.id),
+        func.count(User.id).filter(User.is_active == True),
+        func.count(User.id).filter(User.is_blocked == True),
+        func.count(User.id).filter(User.last_seen >= online_since),
+        db.session.query(func.count(Message.id)).scalar_subquery()
+    ).one()
+    
+    return {
+        'total_users': row[0],
+        'active_users': row[1],
+        'blocked_users': row[2],
+        'online_users': row[3],
+        'total_messages': row[4]
+    }
+
+def invalidate_admin_stats():
+    cache.delete('admin_stats')
+
+def destroy_cloudinary_media(media):
+    """Hapus media dari Cloudinary secara bulk.
+    
+    `media` berisi pasangan (public_id, media_type). Satu panggilan API
+    menghapus hingga CLOUDINARY_DELETE_BATCH file per resource type.
+    """
+    ids_by_type = {}
+    for public_id, media_type in media:
+        if not public_id:
+            continue
+        # Upload 'auto' bisa tersimpan sebagai image (mis. PDF) atau raw
+        resource_types = [media_type] if media_type in ('image', 'video') else ['image', 'raw']
+        for resource_type in resource_types:
+            ids_by_type.setdefault(resource_type, []).append(public_id)
+    
+    for resource_type, public_ids in ids_by_type.items():
+        for i in range(0, len(public_ids), CLOUDINARY_DELETE_BATCH):
+            try:
+                cloudinary.api.delete_resources(
+                    public_ids[i:i + CLOUDINARY_DELETE_BATCH],
+                    resource_type=resource_type
+                )
+            except Exception as e:
+                print(f"Error deleting Cloudinary media: {str(e)}")
+
 def admin_required(f):
     from functools import wraps
     @wraps(f)
@@ -176,16 +415,39 @@ def active_user_required(f):
         return f(*args, **kwargs)
     return decorated_function
 
-# Update last seen before each request
-@app.before_request
-def update_last_seen():
+def touch_last_seen():
+    """Perbarui last_seen current_user, paling banyak sekali per interval"""
     if current_user.is_authenticated and hasattr(current_user, 'id'):
-        current_user.last_seen = datetime.utcnow()
+        now = datetime.utcnow()
+        # Tulis ke database paling banyak sekali per interval, bukan setiap request
+        if current_user.last_seen and now - current_user.last_seen < LAST_SEEN_UPDATE_INTERVAL:
+            return
+        
+        current_user.last_seen = now
         try:
             db.session.commit()
+            invalidate_user_cache(current_user.id)
         except:
             db.session.rollback()
 
+# Update last seen before each request
+@app.before_request
+def update_last_seen():
+    touch_last_seen()
+
+# Kirim CSRF token lewat cookie agar AJAX tidak perlu request tambahan
+@app.after_request
+def set_csrf_cookie(response):
+    if response.mimetype == 'text/html':
+        response.set_cookie(
+            'csrf_token',
+            generate_csrf(),
+            httponly=False,
+            samesite='Strict',
+            secure=request.is_secure
+        )
+    return response
+
 # Routes - Authentication
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -214,11 +476,16 @@ def register():
             flash('Password tidak cocok!', 'error')
             return render_template('register.html')
         
-        if User.query.filter_by(username=username).first():
+        # Cek username dan email sekaligus dalam satu query
+        conflicts = db.session.query(User.username, User.email).filter(
+            (User.username == username) | (User.email == email)
+        ).all()
+        
+        if any(row.username == username for row in conflicts):
             flash('Username sudah digunakan!', 'error')
             return render_template('register.html')
         
-        if User.query.filter_by(email=email).first():
+        if conflicts:
             flash('Email sudah digunakan!', 'error')
             return render_template('register.html')
         
@@ -227,6 +494,7 @@ def register():
         
         db.session.add(user)
         db.session.commit()
+        invalidate_admin_stats()
         
         flash('Registrasi berhasil! Silakan login.', 'success')
         return redirect(url_for('login'))
@@ -254,6 +522,12 @@ def login():
                 flash('Akun Anda diblokir. Silakan hubungi admin.', 'error')
                 return render_template('login.html')
             
+            # Upgrade hash lama ke parameter Argon2 saat ini
+            if user.password_needs_rehash():
+                user.set_password(password)
+                db.session.commit()
+            
+            invalidate_user_cache(user.id)
             login_user(user, remember=remember)
             flash(f'Login berhasil! Selamat datang {user.username}', 'success')
             
@@ -268,6 +542,7 @@ def login():
 @app.route('/logout')
 @login_required
 def logout():
+    invalidate_user_cache(current_user.id)
     logout_user()
     flash('Anda telah logout.', 'info')
     return redirect(url_for('login'))
@@ -280,32 +555,51 @@ def dashboard():
     # Pastikan admin Nayla Asyifa ada
     ensure_admin_exists()
     
+    # Hanya muat kolom yang ditampilkan di daftar user
+    users_query = User.query.options(load_only(
+        User.id, User.username, User.profile_picture, User.bio,
+        User.is_admin, User.is_active, User.is_blocked, User.last_seen
+    ))
+    
     if current_user.is_admin:
         # Admin melihat semua user kecuali dirinya sendiri
-        users = User.query.filter(User.id != current_user.id).order_by(
+        users = users_query.filter(User.id != current_user.id).order_by(
             User.is_admin.desc(), User.username
         ).all()
     else:
         # User biasa hanya melihat admin dan user lain yang aktif
-        users = User.query.filter(
+        users = users_query.filter(
             (User.id != current_user.id) &
             (User.is_active == True) &
             (User.is_blocked == False)
         ).order_by(User.is_admin.desc(), User.username).all()
     
-    # Get unread counts for each user
+    # Hitung pesan belum dibaca per pengirim dalam satu query
+    unread_counts = dict(db.session.query(
+        Message.sender_id, func.count(Message.id)
+    ).filter(
+        Message.receiver_id == current_user.id,
+        Message.is_read == False
+    ).group_by(Message.sender_id).all())
+    
     user_data = []
     for user in users:
-        unread_count = current_user.get_unread_count(user.id)
         user_data.append({
             'user': user,
-            'unread_count': unread_count
+            'unread_count': unread_counts.get(user.id, 0)
         })
     
     return render_template('dashboard.html', user_data=user_data)
 
+# Diset setelah admin dipastikan ada, agar pengecekan hanya sekali per proses
+_admin_checked = False
+
 def ensure_admin_exists():
     """Pastikan admin Nayla Asyifa selalu ada di database"""
+    global _admin_checked
+    if _admin_checked:
+        return
+    
     admin = User.query.filter_by(username='nayla_asyifa', is_admin=True).first()
     if not admin:
         admin = User(
@@ -317,6 +611,8 @@ def ensure_admin_exists():
         db.session.add(admin)
         db.session.commit()
         print("Admin user created: nayla_asyifa / admin123")
+    
+    _admin_checked = True
 
 @app.route('/chat/<int:user_id>')
 @login_required
@@ -329,25 +625,22 @@ def chat(user_id):
         flash('User tidak dapat dihubungi.', 'error')
         return redirect(url_for('dashboard'))
     
-    # Ambil pesan antara current_user dan target_user
-    messages = Message.query.filter(
-        ((Message.sender_id == current_user.id) & (Message.receiver_id == user_id)) |
-        ((Message.sender_id == user_id) & (Message.receiver_id == current_user.id))
-    ).order_by(Message.timestamp.asc()).all()
-    
-    # Tandai pesan sebagai dibaca
-    unread_messages = Message.query.filter(
+    # Tandai pesan sebagai dibaca dengan satu UPDATE
+    Message.query.filter(
         Message.receiver_id == current_user.id,
         Message.sender_id == user_id,
         Message.is_read == False
-    ).all()
-    
-    for msg in unread_messages:
-        msg.is_read = True
-    
+    ).update({'is_read': True}, synchronize_session=False)
     db.session.commit()
     
-    return render_template('chat.html', target_user=target_user, messages=messages)
+    # Ambil halaman terakhir pesan antara current_user dan target_user
+    messages = Message.conversation(current_user.id, user_id).options(
+        joinedload(Message.sender)
+    ).order_by(Message.id.desc()).limit(MESSAGES_PER_PAGE).all()
+    messages.reverse()
+    has_more = len(messages) == MESSAGES_PER_PAGE
+    
+    return render_template('chat.html', target_user=target_user, messages=messages, has_more=has_more)
 
 @app.route('/send_message', methods=['POST'])
 @login_required
@@ -356,7 +649,7 @@ def send_message():
     try:
         receiver_id = request.form.get('receiver_id')
         content = request.form.get('content', '').strip()
-        file = request.files.get('file')
+        files = [f for f in request.files.getlist('file') if f and f.filename]
         
         if not receiver_id:
             return jsonify({'success': False, 'error': 'Receiver ID diperlukan'})
@@ -365,76 +658,154 @@ def send_message():
         if not receiver or not receiver.can_chat():
             return jsonify({'success': False, 'error': 'User tidak dapat dihubungi'})
         
+        # File yang sudah diupload langsung dari browser ke Cloudinary
+        uploaded_url = request.form.get('media_url', '').strip()
+        uploaded_public_id = request.form.get('public_id', '').strip()
+        uploaded_version = request.form.get('version', '').strip()
+        uploaded_signature = request.form.get('signature', '').strip()
+        
         # Validasi: minimal ada content atau file
-        if not content and not (file and file.filename):
+        if not content and not files and not uploaded_url:
             return jsonify({'success': False, 'error': 'Pesan tidak boleh kosong'})
         
-        media_url = None
-        media_type = None
-        public_id = None
+        # Daftar media (url, tipe, public_id), satu pesan per file
+        media = []
         
-        # Handle file upload
-        if file and file.filename:
-            # Validasi file size
-            file.seek(0, 2)  # Seek to end to get size
-            file_size = file.tell()
-            file.seek(0)  # Reset seek position
+        if uploaded_url:
+            if not is_valid_direct_upload(uploaded_url, uploaded_public_id, uploaded_version, uploaded_signature):
+                return jsonify({'success': False, 'error': 'URL file tidak valid'})
             
-            if file_size > 16 * 1024 * 1024:  # 16MB
+            # URL: https://res.cloudinary.com/<cloud>/<image|video|raw>/upload/...
+            resource_type = uploaded_url.split('/')[4]
+            
+            # Signature upload tidak membatasi ukuran file, jadi cek ukuran
+            # aslinya lewat Admin API dan hapus file yang melebihi batas
+            try:
+                uploaded_bytes = cloudinary.api.resource(uploaded_public_id, resource_type=resource_type)['bytes']
+            except Exception:
+                return jsonify({'success': False, 'error': 'File upload tidak ditemukan'})
+            if uploaded_bytes > app.config['MAX_CONTENT_LENGTH']:
+                try:
+                    cloudinary.uploader.destroy(uploaded_public_id, resource_type=resource_type)
+                except Exception as e:
+                    print(f"Error deleting Cloudinary media: {str(e)}")
                 return jsonify({'success': False, 'error': 'File terlalu besar. Maksimal 16MB'})
             
-            upload_result = upload_to_cloudinary(file)
-            if upload_result['success']:
-                media_url = upload_result['url']
-                media_type = upload_result['resource_type']
-                public_id = upload_result['public_id']
-            else:
-                return jsonify({'success': False, 'error': 'Gagal mengupload file: ' + upload_result['error']})
-        
-        # Buat pesan baru
-        message = Message(
-            content=content if content else None,
-            media_url=media_url,
-            media_type=media_type,
-            sender_id=current_user.id,
-            receiver_id=receiver_id
-        )
+            media.append((uploaded_url, get_media_type(resource_type, uploaded_url.split('?')[0]), uploaded_public_id))
+        
+        # Handle file upload
+        # Ukuran file sudah dibatasi oleh MAX_CONTENT_LENGTH
+        elif files:
+            for upload_result in upload_many(files):
+                if not upload_result['success']:
+                    return jsonify({'success': False, 'error': 'Gagal mengupload file: ' + upload_result['error']})
+                media.append((upload_result['url'], upload_result['resource_type'], upload_result['public_id']))
         
-        db.session.add(message)
+        # Buat pesan baru; teks ikut pada pesan pertama
+        messages = []
+        for media_url, media_type, public_id in media or [(None, None, None)]:
+            messages.append(Message(
+                content=content if content and not messages else None,
+                media_url=media_url,
+                media_type=media_type,
+                public_id=public_id,
+                sender_id=current_user.id,
+                receiver_id=receiver_id
+            ))
+        
+        db.session.add_all(messages)
         db.session.commit()
+        invalidate_admin_stats()
+        
+        messages_data = [message.to_dict() for message in messages]
+        
+        # Kirim pesan baru langsung ke penerima lewat WebSocket
+        for message_data in messages_data:
+            socketio.emit('new_message', message_data, to=f'user:{receiver.id}')
         
         return jsonify({
             'success': True,
-            'message': message.to_dict(),
-            'public_id': public_id
+            'message': messages_data[0],
+            'messages': messages_data,
+            'public_id': media[0][2] if media else None
         })
         
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/cloudinary/sign')
+@login_required
+@active_user_required
+def cloudinary_sign():
+    """Signature untuk upload file langsung dari browser ke Cloudinary"""
+    config = cloudinary.config()
+    timestamp = int(time.time())
+    folder = 'chat_app'
+    # Semua parameter yang ditandatangani wajib dikirim apa adanya oleh browser,
+    # jadi signature ini hanya berlaku untuk format file chat
+    signature = cloudinary.utils.api_sign_request(
+        {'timestamp': timestamp, 'folder': folder, 'allowed_formats': DIRECT_UPLOAD_FORMATS},
+        config.api_secret
+    )
+    
+    return jsonify({
+        'success': True,
+        'signature': signature,
+        'timestamp': timestamp,
+        'folder': folder,
+        'allowed_formats': DIRECT_UPLOAD_FORMATS,
+        'api_key': config.api_key,
+        'cloud_name': config.cloud_name
+    })
+
 @app.route('/get_messages/<int:user_id>')
 @login_required
 @active_user_required
 def get_messages(user_id):
     last_message_id = request.args.get('last_message_id', 0, type=int)
     
-    messages = Message.query.filter(
-        ((Message.sender_id == current_user.id) & (Message.receiver_id == user_id)) |
-        ((Message.sender_id == user_id) & (Message.receiver_id == current_user.id)),
-        Message.id > last_message_id
-    ).order_by(Message.timestamp.asc()).all()
+    messages = Message.conversation(
+        current_user.id, user_id, Message.id > last_message_id
+    ).order_by(Message.id.asc()).all()
     
-    # Tandai pesan sebagai dibaca
-    unread_messages = [msg for msg in messages if msg.receiver_id == current_user.id and not msg.is_read]
-    for msg in unread_messages:
-        msg.is_read = True
+    # Serialisasi sebelum commit agar objek tidak perlu dimuat ulang
+    messages_data = Message.bulk_to_dict(messages)
     
-    if unread_messages:
+    # Tandai pesan sebagai dibaca dengan satu UPDATE
+    unread_ids = [msg.id for msg in messages if msg.receiver_id == current_user.id and not msg.is_read]
+    if unread_ids:
+        Message.query.filter(
+            Message.receiver_id == current_user.id,
+            Message.sender_id == user_id,
+            Message.is_read == False,
+            Message.id > last_message_id,
+            Message.id <= max(unread_ids)
+        ).update({'is_read': True}, synchronize_session=False)
         db.session.commit()
     
     return jsonify({
         'success': True,
-        'messages': [msg.to_dict() for msg in messages]
+        'messages': messages_data
+    })
+
+@app.route('/get_messages_before/<int:user_id>')
+@login_required
+@active_user_required
+def get_messages_before(user_id):
+    """Halaman pesan yang lebih lama dari before_id (keyset pagination)"""
+    before_id = request.args.get('before_id', type=int)
+    if not before_id:
+        return jsonify({'success': False, 'error': 'before_id diperlukan'})
+    
+    messages = Message.conversation(
+        current_user.id, user_id, Message.id < before_id
+    ).order_by(Message.id.desc()).limit(MESSAGES_PER_PAGE).all()
+    messages.reverse()
+    
+    return jsonify({
+        'success': True,
+        'messages': Message.bulk_to_dict(messages),
+        'has_more': len(messages) == MESSAGES_PER_PAGE
     })
 
 @app.route('/delete_message/<int:message_id>', methods=['POST'])
@@ -450,20 +821,39 @@ def delete_message(message_id):
         
         # Hapus file dari Cloudinary jika ada
         if message.media_url and current_user.is_admin:
-            try:
-                public_id = message.media_url.split('/')[-1].split('.')[0]
-                cloudinary.uploader.destroy(f"chat_app/{public_id}")
-            except:
-                pass
+            if message.public_id:
+                destroy_cloudinary_media([(message.public_id, message.media_type)])
+            else:
+                # Pesan lama belum menyimpan public_id
+                try:
+                    public_id = message.media_url.split('/')[-1].split('.')[0]
+                    cloudinary.uploader.destroy(f"chat_app/{public_id}")
+                except:
+                    pass
         
         db.session.delete(message)
         db.session.commit()
+        invalidate_admin_stats()
         
         return jsonify({'success': True})
         
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+# Socket.IO - setiap user bergabung ke room miliknya untuk menerima pesan baru
+@socketio.on('connect')
+def handle_connect():
+    if not current_user.is_authenticated:
+        return False
+    join_room(f'user:{current_user.id}')
+    # Event Socket.IO tidak melewati before_request
+    touch_last_seen()
+
+@socketio.on('heartbeat')
+def handle_heartbeat():
+    # Dikirim berkala oleh halaman chat yang terbuka selama polling HTTP berhenti
+    touch_last_seen()
+
 # Routes - Profile
 @app.route('/profile')
 @login_required
@@ -518,6 +908,7 @@ def update_profile():
                     flash('Format file tidak didukung. Gunakan JPG, PNG, atau GIF.', 'error')
         
         db.session.commit()
+        invalidate_user_cache(current_user.id)
         flash('Profil berhasil diperbarui!', 'success')
         
     except Exception as e:
@@ -542,6 +933,7 @@ def change_password():
     else:
         current_user.set_password(new_password)
         db.session.commit()
+        invalidate_user_cache(current_user.id)
         flash('Password berhasil diubah!', 'success')
     
     return redirect(url_for('profile'))
@@ -560,19 +952,14 @@ def view_user_profile(user_id):
 def admin_dashboard():
     users = User.query.filter(User.id != current_user.id).order_by(User.created_at.desc()).all()
     
-    # Hitung statistik
-    total_users = User.query.count() - 1  # exclude admin
-    active_users = User.query.filter_by(is_active=True).count() - 1
-    blocked_users = User.query.filter_by(is_blocked=True).count()
-    total_messages = Message.query.count()
-    online_users = User.query.filter(User.last_seen >= datetime.utcnow() - timedelta(minutes=5)).count() - 1
-    
+    # Hitung statistik (exclude admin)
+    admin_stats = get_admin_stats()
     stats = {
-        'total_users': total_users,
-        'active_users': active_users,
-        'blocked_users': blocked_users,
-        'total_messages': total_messages,
-        'online_users': online_users
+        'total_users': admin_stats['total_users'] - 1,
+        'active_users': admin_stats['active_users'] - 1,
+        'blocked_users': admin_stats['blocked_users'],
+        'total_messages': admin_stats['total_messages'],
+        'online_users': admin_stats['online_users'] - 1
     }
     
     return render_template('admin_dashboard.html', users=users, stats=stats)
@@ -588,6 +975,8 @@ def toggle_block_user(user_id):
     else:
         user.is_blocked = not user.is_blocked
         db.session.commit()
+        invalidate_admin_stats()
+        invalidate_user_cache(user_id)
         
         action = "diblokir" if user.is_blocked else "dibuka blokirnya"
         flash(f'User {user.username} berhasil {action}!', 'success')
@@ -605,6 +994,8 @@ def toggle_active_user(user_id):
     else:
         user.is_active = not user.is_active
         db.session.commit()
+        invalidate_admin_stats()
+        invalidate_user_cache(user_id)
         
         action = "dinonaktifkan" if not user.is_active else "diaktifkan"
         flash(f'User {user.username} berhasil {action}!', 'success')
@@ -622,12 +1013,20 @@ def delete_user(user_id):
         return redirect(url_for('admin_dashboard'))
     
     # Hapus semua pesan yang terkait dengan user
-    Message.query.filter(
+    user_messages = Message.query.filter(
         (Message.sender_id == user_id) | (Message.receiver_id == user_id)
-    ).delete()
+    )
+    media = user_messages.filter(Message.public_id.isnot(None)).with_entities(
+        Message.public_id, Message.media_type
+    ).all()
+    user_messages.delete()
     
     db.session.delete(user)
     db.session.commit()
+    invalidate_admin_stats()
+    invalidate_user_cache(user_id)
+    
+    destroy_cloudinary_media(media)
     
     flash(f'User {user.username} berhasil dihapus!', 'success')
     return redirect(url_for('admin_dashboard'))
@@ -637,12 +1036,7 @@ def delete_user(user_id):
 @admin_required
 def admin_settings():
     # Hitung statistik untuk template
-    stats = {
-        'total_users': User.query.count(),
-        'total_messages': Message.query.count(),
-        'active_users': User.query.filter_by(is_active=True).count(),
-        'blocked_users': User.query.filter_by(is_blocked=True).count()
-    }
+    stats = get_admin_stats()
     
     if request.method == 'POST':
         # Update admin profile
@@ -651,16 +1045,14 @@ def admin_settings():
         
         # Validasi username unique
         if new_username != current_user.username:
-            existing_user = User.query.filter_by(username=new_username).first()
-            if existing_user:
+            if db.session.query(User.query.filter_by(username=new_username).exists()).scalar():
                 flash('Username sudah digunakan!', 'error')
                 return redirect(url_for('admin_settings'))
             current_user.username = new_username
         
         # Validasi email unique
         if new_email != current_user.email:
-            existing_email = User.query.filter_by(email=new_email).first()
-            if existing_email:
+            if db.session.query(User.query.filter_by(email=new_email).exists()).scalar():
                 flash('Email sudah digunakan!', 'error')
                 return redirect(url_for('admin_settings'))
             current_user.email = new_email
@@ -696,6 +1088,7 @@ def admin_settings():
                     current_user.profile_picture = upload_result['url']
         
         db.session.commit()
+        invalidate_user_cache(current_user.id)
         flash('Pengaturan admin berhasil diperbarui!', 'success')
         return redirect(url_for('admin_settings'))
     
@@ -708,8 +1101,14 @@ def delete_all_messages():
     try:
         # Hapus semua pesan
         num_messages = Message.query.count()
+        media = Message.query.filter(Message.public_id.isnot(None)).with_entities(
+            Message.public_id, Message.media_type
+        ).all()
         Message.query.delete()
         db.session.commit()
+        invalidate_admin_stats()
+        
+        destroy_cloudinary_media(media)
         
         flash(f'Berhasil menghapus {num_messages} pesan!', 'success')
     except Exception as e:
@@ -729,6 +1128,10 @@ def internal_error(error):
 
 @app.errorhandler(413)
 def too_large(error):
+    # Werkzeug menolak body dari header Content-Length (MAX_CONTENT_LENGTH)
+    # sebelum view dijalankan; request AJAX mengharapkan JSON
+    if request.path == url_for('send_message') or request.accept_mimetypes.best == 'application/json':
+        return jsonify({'success': False, 'error': 'File terlalu besar. Maksimal 16MB'}), 413
     flash('File terlalu besar. Maksimal 16MB.', 'error')
     return redirect(request.referrer or url_for('dashboard'))
 
@@ -744,13 +1147,65 @@ def bad_request(error):
 def create_tables():
     with app.app_context():
         db.create_all()
+        upgrade_schema()
         ensure_admin_exists()
 
-# CSRF token route untuk AJAX
-@app.route('/get_csrf')
-def get_csrf():
-    return jsonify({'csrf_token': generate_csrf()})
+def is_json_list(value):
+    try:
+        return isinstance(json.loads(value), list)
+    except (TypeError, ValueError):
+        return False
+
+def upgrade_schema():
+    """Tambahkan kolom dan index baru ke database yang sudah ada"""
+    # create_all tidak mengubah tabel yang sudah ada
+    inspector = db.inspect(db.engine)
+    columns = {column['name'] for column in inspector.get_columns('message')}
+    if 'public_id' not in columns:
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(db.text('ALTER TABLE message ADD COLUMN public_id VARCHAR(255)'))
+        except (OperationalError, ProgrammingError):
+            # Kolom sudah ada (SQLite memakai OperationalError, PostgreSQL
+            # ProgrammingError); upgrade hanya dijalankan sekali saat startup
+            pass
+    
+    # social_links dulu disimpan sebagai TEXT berisi JSON; nilai yang bukan
+    # JSON list diganti '[]' agar tidak gagal saat dibaca atau di-cast
+    if db.engine.dialect.name == 'postgresql':
+        user_columns = {column['name']: column for column in inspector.get_columns('user')}
+        if not isinstance(user_columns['social_links']['type'], JSONB):
+            with db.engine.begin() as conn:
+                rows = conn.execute(db.text('SELECT id, social_links FROM "user"')).all()
+                invalid_ids = [row.id for row in rows if not is_json_list(row.social_links)]
+                if invalid_ids:
+                    conn.execute(
+                        db.text('''UPDATE "user" SET social_links = '[]' WHERE id = :id'''),
+                        [{'id': user_id} for user_id in invalid_ids]
+                    )
+                conn.execute(db.text(
+                    'ALTER TABLE "user" ALTER COLUMN social_links TYPE JSONB '
+                    'USING social_links::jsonb'
+                ))
+    elif db.engine.dialect.name == 'sqlite':
+        with db.engine.begin() as conn:
+            conn.execute(db.text(
+                '''UPDATE "user" SET social_links = '[]' WHERE CASE '''
+                "WHEN json_valid(social_links) THEN json_type(social_links) != 'array' "
+                'ELSE 1 END'
+            ))
+    
+    for index in Message.__table__.indexes:
+        index.create(bind=db.engine, checkfirst=True)
 
 if __name__ == '__main__':
+    # Deteksi query N+1 saat development (opsional)
+    try:
+        from nplusone.ext.flask_sqlalchemy import NPlusOne
+        app.config['NPLUSONE_RAISE'] = False
+        NPlusOne(app)
+    except ImportError:
+        pass
+    
     create_tables()
-    app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
+    socketio.run(app, debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,49 @@
+import multiprocessing
+import os
+import subprocess
+import sys
+
+# Konfigurasi Gunicorn untuk production
+# Tanpa Redis, cache dan room Socket.IO hanya ada di memori satu proses,
+# jadi gunakan satu worker kecuali REDIS_URL diset
+if os.environ.get('REDIS_URL'):
+    default_workers = multiprocessing.cpu_count() * 2 + 1
+else:
+    default_workers = 1
+workers = int(os.environ.get('WEB_CONCURRENCY', default_workers))
+# Diteruskan ke worker agar pool koneksi database dibagi sesuai jumlah worker
+os.environ['WEB_CONCURRENCY'] = str(workers)
+
+# Worker gevent (dengan dukungan WebSocket untuk Socket.IO): setiap request
+# berjalan sebagai greenlet yang mengalah saat menunggu I/O (upload
+# Cloudinary, query database). Gunicorn menjalankan monkey.patch_all()
+# sendiri sebelum aplikasi dimuat.
+worker_class = 'geventwebsocket.gunicorn.workers.GeventWebSocketWorker'
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+timeout = 120
+keepalive = 5
+
+
+def post_fork(server, worker):
+    # Buat driver PostgreSQL kooperatif dengan gevent jika terpasang
+    try:
+        from psycogreen.gevent import patch_psycopg
+    except ImportError:
+        if os.environ.get('DATABASE_URL', '').startswith('postgres'):
+            server.log.warning(
+                'psycogreen tidak terpasang: query PostgreSQL akan memblokir '
+                'semua greenlet di worker %s', worker.pid
+            )
+        return
+    patch_psycopg()
+
+
+def on_starting(server):
+    # Buat tabel, jalankan upgrade skema, dan pastikan admin ada sekali saja
+    # sebelum worker dibuat. Dijalankan di proses terpisah agar aplikasi tidak
+    # di-import oleh master sebelum gevent melakukan monkey patching.
+    subprocess.run(
+        [sys.executable, '-c', 'from app import create_tables; create_tables()'],
+        check=True
+    )
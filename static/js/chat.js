@@ -248,7 +248,7 @@ class ChatManager {
         
         content += `
             <div class="flex items-center justify-between mt-1 text-xs opacity-75">
-                <span class="message-time">${message.timestamp}</span>
+                <span class="message-time">${this.formatTime(message.timestamp)}</span>
                 <div class="flex items-center space-x-1">
                     ${message.is_read && isSent ? 
                         '<i class="fas fa-check-double text-blue-400" title="Telah dibaca"></i>' : 
@@ -270,6 +270,11 @@ class ChatManager {
         return messageDiv;
     }
 
+    formatTime(isoTimestamp) {
+        // Tampilkan jam sesuai zona waktu browser
+        return new Date(isoTimestamp).toLocaleTimeString([], { hour: '2-digit', minute: '2-digit' });
+    }
+
     urlize(text) {
         const urlRegex = /(https?:\/\/[^\s]+)/g;
         return text.replace(urlRegex, '<a href="$1" target="_blank" class="text-blue-600 hover:text-blue-800 underline break-all">$1</a>');
@@ -463,7 +468,7 @@ class ChatManager {
                 method: 'POST',
                 headers: {
                     'Content-Type': 'application/json',
-                    'X-CSRFToken': csrfToken
+                    'X-CSRFToken': getCsrfToken()
                 }
             });
             
@@ -631,13 +636,18 @@ class ChatManager {
     }
 }
 
+function getCsrfToken() {
+    // CSRF token dikirim server lewat cookie pada setiap halaman HTML
+    const match = document.cookie.match(/(?:^|;\s*)csrf_token=([^;]*)/);
+    return match ? decodeURIComponent(match[1]) : '';
+}
+
 // Initialize global chat manager
 const chatManager = new ChatManager();
 
 // Global variables (should be set by the template)
 let currentUserId = null;
 let currentUserIsAdmin = false;
-let csrfToken = '';
 
 // Auto-initialize when DOM is loaded
 document.addEventListener('DOMContentLoaded', function() {
@@ -646,7 +656,6 @@ document.addEventListener('DOMContentLoaded', function() {
     if (chatContainer) {
         currentUserId = parseInt(chatContainer.dataset.currentUserId || '0');
         currentUserIsAdmin = chatContainer.dataset.currentUserIsAdmin === 'true';
-        csrfToken = document.querySelector('meta[name="csrf-token"]')?.content || '';
         
         const targetUserId = document.querySelector('input[name="receiver_id"]')?.value;
         if (targetUserId) {